@@ -1,39 +1,57 @@
 #!/usr/bin/env python3
 import os
-import time
+import json
+import atexit
 import sqlite3
 import logging
+import functools
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree, html as lxml_html
 from telegram import Bot, ParseMode
+from telegram.utils.request import Request
 from telegram.error import TelegramError
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.blocking import BlockingScheduler
 from pytz import utc
 from flask import Flask, request
+from waitress import serve
 
 # Optional OpenAI import - used only if OPENAI_API_KEY is set
 try:
-    import openai
+    from openai import OpenAI
     OPENAI_AVAILABLE = True
 except Exception:
     OPENAI_AVAILABLE = False
 
+# Optional Tweepy import - used for X filtered stream (push instead of polling)
+try:
+    import tweepy
+    TWEEPY_AVAILABLE = True
+except Exception:
+    TWEEPY_AVAILABLE = False
+
 # === KONFIGURACJA ===
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 TARGET_CHAT_ID = int(os.getenv("TARGET_CHAT_ID", "0"))
 X_BEARER_TOKEN = os.getenv("X_BEARER_TOKEN", "")
 X_USERNAME = os.getenv("X_USERNAME", "")
+X_STREAM = os.getenv("X_STREAM", "1") == "1"
 FOREX_FACTORY_URL = os.getenv("FOREX_FACTORY_URL", "https://www.forexfactory.com/calendar.php")
+FOREX_MAX_BYTES = int(os.getenv("FOREX_MAX_BYTES", "2000000"))
 FOREX_DAILY_HOUR = int(os.getenv("FOREX_DAILY_HOUR", "8"))
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "300"))
 DB_PATH = os.getenv("DB_PATH", "bot_data.db")
+SENT_RETENTION_DAYS = int(os.getenv("SENT_RETENTION_DAYS", "30"))
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+AI_CONCURRENCY = int(os.getenv("AI_CONCURRENCY", "8"))
 
 # Configure OpenAI if available
-if OPENAI_API_KEY and OPENAI_AVAILABLE:
-    openai.api_key = OPENAI_API_KEY
+ai_client = OpenAI(api_key=OPENAI_API_KEY, timeout=30) if OPENAI_API_KEY and OPENAI_AVAILABLE else None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -42,71 +60,228 @@ if not TELEGRAM_TOKEN or TARGET_CHAT_ID == 0:
     logger.error("Brakuje TELEGRAM_TOKEN lub TARGET_CHAT_ID - ustaw zmienne środowiskowe.")
     raise SystemExit("Brakuje TELEGRAM_TOKEN lub TARGET_CHAT_ID")
 
-bot = Bot(token=TELEGRAM_TOKEN)
+bot = Bot(token=TELEGRAM_TOKEN, request=Request(con_pool_size=8))
+
+# === HTTP ===
+# Jedna sesja z pulą połączeń (keep-alive) dla wszystkich zapytań HTTP
+HTTP = requests.Session()
+HTTP.headers.update({"User-Agent": "news-bot/1.0"})
+HTTP.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=10,
+    # raise_on_status=False: po wyczerpaniu prób zwracamy odpowiedź, żeby
+    # istniejąca obsługa status_code (np. 429 z X) dalej działała
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                      raise_on_status=False),
+))
 
 # --- Set webhook for Telegram ---
 RENDER_URL = os.getenv("RENDER_EXTERNAL_URL")
-if RENDER_URL:
+
+def setup_webhook():
+    """Tryb webhook, jeśli jest RENDER_EXTERNAL_URL; inaczej bot tylko publikuje wpisy."""
+    if not RENDER_URL:
+        logger.warning("⚠️ Brak RENDER_EXTERNAL_URL — webhook nie został ustawiony")
+        return
     webhook_url = f"{RENDER_URL}/{TELEGRAM_TOKEN}"
     try:
         bot.set_webhook(url=webhook_url)
         logger.info(f"✅ Webhook ustawiony na: {webhook_url}")
     except Exception as e:
         logger.exception("Nie udało się ustawić webhooka: %s", e)
-else:
-    logger.warning("⚠️ Brak RENDER_EXTERNAL_URL — webhook nie został ustawiony")
 
 # === BAZA DANYCH ===
+_conn_local = threading.local()
+
+def get_conn() -> sqlite3.Connection:
+    """Zwraca połączenie SQLite dla bieżącego wątku (tworzone raz, z PRAGMA)."""
+    conn = getattr(_conn_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA busy_timeout=60000")
+        _conn_local.conn = conn
+    return conn
+
+_SENT_ITEMS_DDL = """
+  CREATE TABLE IF NOT EXISTS {name} (
+    id TEXT PRIMARY KEY,
+    source TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+  ) WITHOUT ROWID
+"""
+
+def _migrate_sent_items(conn):
+    """Przebudowuje starą tabelę sent_items (z ukrytym rowid) na WITHOUT ROWID."""
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='sent_items'").fetchone()[0]
+    if "WITHOUT ROWID" in sql.upper():
+        return
+    logger.info("Migracja sent_items do WITHOUT ROWID...")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DROP TABLE IF EXISTS sent_items_new")
+        conn.execute(_SENT_ITEMS_DDL.format(name="sent_items_new"))
+        conn.execute("INSERT OR IGNORE INTO sent_items_new(id, source, created_at) "
+                     "SELECT id, source, created_at FROM sent_items")
+        conn.execute("DROP TABLE sent_items")
+        conn.execute("ALTER TABLE sent_items_new RENAME TO sent_items")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-      CREATE TABLE IF NOT EXISTS sent_items (
-        id TEXT PRIMARY KEY,
-        source TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-      )
-    """)
-    conn.commit()
-    conn.close()
+    conn = get_conn()
+    conn.execute(_SENT_ITEMS_DDL.format(name="sent_items"))
+    _migrate_sent_items(conn)
+    conn.execute("DROP INDEX IF EXISTS idx_sent_items_source")
+    conn.execute("DROP INDEX IF EXISTS idx_sent_items_source_id")
+    # Indeks pod prune_sent_job (source = ? AND created_at < ?)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sent_items_source_created ON sent_items(source, created_at)")
+    conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+    conn.execute("ANALYZE sent_items")
+    with _pending_lock:
+        _SENT_IDS.clear()
+        _SENT_IDS.update(row[0] for row in conn.execute("SELECT id FROM sent_items"))
+
+def kv_get(key: str):
+    row = get_conn().execute("SELECT value FROM kv WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+def kv_set(key: str, value: str):
+    get_conn().execute("INSERT OR REPLACE INTO kv(key, value) VALUES (?, ?)", (key, value))
+
+def kv_delete(key: str):
+    get_conn().execute("DELETE FROM kv WHERE key=?", (key,))
+
+# Bufor zapisów: mark_sent tylko dopisuje, flush_sent zapisuje całość w jednej transakcji.
+# _SENT_IDS to kopia wszystkich id z sent_items w pamięci - was_sent nie dotyka SQLite.
+_FLUSH_EVERY = 50
+_pending = []
+_pending_lock = threading.Lock()
+_SENT_IDS = set()
 
 def mark_sent(item_id: str, source: str):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    with _pending_lock:
+        _pending.append((item_id, source))
+        _SENT_IDS.add(item_id)
+        full = len(_pending) >= _FLUSH_EVERY
+    if full:
+        flush_sent()
+
+def flush_sent():
+    with _pending_lock:
+        rows = _pending[:]
+        _pending.clear()
+    if not rows:
+        return
     try:
-        cur.execute("INSERT INTO sent_items(id, source) VALUES (?, ?)", (item_id, source))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass
-    conn.close()
+        mark_sent_many(rows)
+    except Exception:
+        with _pending_lock:
+            _pending[:0] = rows
+        raise
+
+def mark_sent_many(rows):
+    """Zapisuje wiele par (id, source) w jednej transakcji."""
+    rows = list(rows)
+    if not rows:
+        return
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("INSERT OR IGNORE INTO sent_items(id, source) VALUES (?, ?)", rows)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    # Odświeża statystyki planera tylko wtedy, gdy SQLite uzna to za potrzebne
+    conn.execute("PRAGMA optimize")
 
 def was_sent(item_id: str) -> bool:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM sent_items WHERE id=?", (item_id,))
-    r = cur.fetchone()
-    conn.close()
-    return r is not None
+    return item_id in _SENT_IDS
+
+def filter_sent(ids) -> set:
+    """Zwraca podzbiór `ids`, które już zostały wysłane."""
+    return {item_id for item_id in ids if item_id in _SENT_IDS}
+
+_PRUNABLE_SOURCES = ("forex",)
+
+def prune_sent_job():
+    """Usuwa wpisy starsze niż SENT_RETENTION_DAYS z bazy i z pamięci.
+
+    Wpisy z X zostają (nie ma ich w _PRUNABLE_SOURCES) - po restarcie timeline X
+    zwraca ostatnie posty niezależnie od ich wieku, więc usunięcie ich id mogłoby
+    spowodować ponowną wysyłkę.
+    """
+    if SENT_RETENTION_DAYS <= 0:
+        return
+    try:
+        flush_sent()
+        conn = get_conn()
+        cutoff = f"-{SENT_RETENTION_DAYS} days"
+        where = "source = ? AND created_at < datetime('now', ?)"
+        old = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for source in _PRUNABLE_SOURCES:
+                params = (source, cutoff)
+                old += [row[0] for row in conn.execute(f"SELECT id FROM sent_items WHERE {where}", params)]
+                conn.execute(f"DELETE FROM sent_items WHERE {where}", params)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("ANALYZE sent_items")
+        with _pending_lock:
+            _SENT_IDS.difference_update(old)
+        logger.info("Usunięto %d starych wpisów z sent_items", len(old))
+    except Exception as e:
+        logger.exception("Błąd w prune_sent_job: %s", e)
 
 # === TWITTER / X ===
 last_seen_x_id = None
 
-def fetch_latest_from_x(username, bearer_token, since_id=None):
-    if not bearer_token or not username:
-        return []
+@functools.lru_cache(maxsize=16)
+def _resolve_x_user_id(username, bearer_token):
+    """Zwraca id usera X (niezmienne) - z pamięci, z bazy albo z API."""
+    key = f"x_user_id:{username.lower()}"
+    user_id = kv_get(key)
+    if user_id:
+        return user_id
     headers = {"Authorization": f"Bearer {bearer_token}"}
-    user = requests.get(f"https://api.twitter.com/2/users/by/username/{username}", headers=headers, timeout=15)
+    user = HTTP.get(f"https://api.twitter.com/2/users/by/username/{username}", headers=headers, timeout=15)
     if user.status_code != 200:
-        logger.warning("Błąd pobierania usera z X: %s", user.text[:200])
-        return []
+        raise LookupError(f"Błąd pobierania usera z X: {user.text[:200]}")
     user_id = user.json().get("data", {}).get("id")
     if not user_id:
+        raise LookupError(f"Nie znaleziono usera X: {username}")
+    kv_set(key, user_id)
+    return user_id
+
+def _forget_x_user_id(username):
+    _resolve_x_user_id.cache_clear()
+    kv_delete(f"x_user_id:{username.lower()}")
+
+def fetch_latest_from_x(username, bearer_token, since_id=None):
+    if not bearer_token or not username:
+        return []
+    headers = {"Authorization": f"Bearer {bearer_token}"}
+    try:
+        user_id = _resolve_x_user_id(username, bearer_token)
+    except LookupError as e:
+        logger.warning("%s", e)
         return []
     params = {"max_results": 5, "tweet.fields": "created_at,text"}
     if since_id:
         params["since_id"] = since_id
-    res = requests.get(f"https://api.twitter.com/2/users/{user_id}/tweets", headers=headers, params=params, timeout=15)
+    res = HTTP.get(f"https://api.twitter.com/2/users/{user_id}/tweets", headers=headers, params=params, timeout=15)
     if res.status_code != 200:
+        if res.status_code in (401, 404):
+            _forget_x_user_id(username)
         logger.warning("Błąd pobierania tweetów: %s", res.text[:200])
         return []
     tweets = res.json().get("data", [])
@@ -120,61 +295,203 @@ def fetch_latest_from_x(username, bearer_token, since_id=None):
         })
     return out
 
-def x_poll_job():
+def send_tweet(t):
     global last_seen_x_id
+    tid = t["id"]
+    uid = f"x:{tid}"
+    # Rezerwujemy id przed wysyłką - poll i stream mogą równolegle dostać ten sam wpis
+    with _pending_lock:
+        if uid in _SENT_IDS:
+            return
+        _SENT_IDS.add(uid)
+    message = f"📰 Nowy wpis z X ({X_USERNAME}):\n\n{t['text']}\n\n{t['url']}"
+    try:
+        bot.send_message(TARGET_CHAT_ID, message)
+        mark_sent(uid, "x")
+        last_seen_x_id = tid
+        logger.info("Wysłano wpis X %s", tid)
+    except TelegramError as e:
+        # Zwalniamy rezerwację, żeby wpis został ponowiony przy następnej okazji
+        with _pending_lock:
+            _SENT_IDS.discard(uid)
+        logger.exception("Błąd wysyłki do Telegrama: %s", e)
+
+def x_poll_job():
     try:
         tweets = fetch_latest_from_x(X_USERNAME, X_BEARER_TOKEN, since_id=last_seen_x_id)
         tweets = sorted(tweets, key=lambda t: t.get("created_at", ""))
+        already = filter_sent(f"x:{t['id']}" for t in tweets)
         for t in tweets:
-            tid = t["id"]
-            uid = f"x:{tid}"
-            if was_sent(uid):
+            if f"x:{t['id']}" in already:
                 continue
-            message = f"📰 Nowy wpis z X ({X_USERNAME}):\n\n{t['text']}\n\n{t['url']}"
-            try:
-                bot.send_message(TARGET_CHAT_ID, message)
-                mark_sent(uid, "x")
-                last_seen_x_id = tid
-                logger.info("Wysłano wpis X %s", tid)
-            except TelegramError as e:
-                logger.exception("Błąd wysyłki do Telegrama: %s", e)
+            send_tweet(t)
+        flush_sent()
     except Exception as e:
         logger.exception("Błąd w x_poll_job: %s", e)
 
+# Tag reguł dodawanych przez bota - inne reguły aplikacji zostają nietknięte
+_X_RULE_TAG = "news-bot"
+
+if TWEEPY_AVAILABLE:
+    class XStream(tweepy.StreamingClient):
+        """Filtered stream X - nowe wpisy przychodzą od razu, bez pollingu."""
+
+        def __init__(self, bearer_token, username, on_unavailable):
+            # Bez czekania na limit - 429 przy regułach kończy się przejściem na polling,
+            # a ponowne łączenie streamu tweepy i tak obsługuje z własnym backoffem
+            super().__init__(bearer_token, wait_on_rate_limit=False)
+            self.username = username
+            self.on_unavailable = on_unavailable
+
+        def on_response(self, response):
+            # Stream dostarcza wpisy dla wszystkich reguł aplikacji - bierzemy tylko własne
+            if not any(r.tag == _X_RULE_TAG for r in response.matching_rules or []):
+                return
+            try:
+                tweet = response.data
+                tid = str(tweet.id)
+                send_tweet({
+                    "id": tid,
+                    "text": tweet.text,
+                    "created_at": tweet.created_at.isoformat() if tweet.created_at else "",
+                    "url": f"https://x.com/{self.username}/status/{tid}"
+                })
+                flush_sent()
+            except Exception as e:
+                logger.exception("Błąd w streamie X: %s", e)
+
+        def on_request_error(self, status_code):
+            logger.warning("Błąd streamu X: HTTP %s", status_code)
+            # Brak dostępu do filtered stream (np. plan API bez streamingu)
+            if status_code in (401, 403):
+                self.disconnect()
+                self.on_unavailable()
+
+def start_x_stream(on_unavailable):
+    stream = XStream(X_BEARER_TOKEN, X_USERNAME, on_unavailable)
+    rule = f"from:{X_USERNAME}"
+    ours = [r for r in (stream.get_rules().data or []) if r.tag == _X_RULE_TAG]
+    # Usuwamy tylko własne reguły po zmianie X_USERNAME
+    stale = [r.id for r in ours if r.value != rule]
+    if stale:
+        stream.delete_rules(stale)
+    if not any(r.value == rule for r in ours):
+        stream.add_rules(tweepy.StreamRule(rule, tag=_X_RULE_TAG))
+    stream.filter(tweet_fields=["created_at"], threaded=True)
+    logger.info("Stream X uruchomiony dla %s", rule)
+    return stream
+
+def start_x_stream_job(scheduler):
+    """Uruchamia stream X z wątku harmonogramu - zapytania o reguły nie blokują startu."""
+    try:
+        start_x_stream(on_unavailable=lambda: schedule_x_polling(scheduler))
+    except Exception as e:
+        logger.exception("Nie udało się uruchomić streamu X, przechodzę na polling: %s", e)
+        schedule_x_polling(scheduler)
+
 # === FOREX FACTORY SCRAPER ===
+_ROW_XPATH = etree.XPath("//table[@id='calendar']//tbody//tr")
+_TD_XPATH = etree.XPath(".//td")
+
+# Poziom ważności: 0 = low, 1 = medium, 2 = high. Kolejność ma znaczenie -
+# "low" sprawdzamy najpierw. Na ForexFactory żółta ikona oznacza low impact.
+_IMPACT_LEVEL = {
+    "low": 0, "yellow": 0,
+    "medium": 1, "med": 1, "orange": 1,
+    "high": 2, "important": 2, "red": 2,
+}
+
+def impact_level(impact: str) -> int:
+    """Zwraca poziom ważności (0-2) lub -1, jeśli nie rozpoznano."""
+    impact_l = impact.lower()
+    return next((lvl for key, lvl in _IMPACT_LEVEL.items() if key in impact_l), -1)
+
+def _cell_text(td) -> str:
+    return (td.text_content() or "").strip()
+
+# Walidatory HTTP i sparsowane wydarzenia z ostatniego pobrania (zapisywane w kv)
+_FF_CACHE_KEY = "ff_cache"
+_ff_cache = None
+
+def _load_ff_cache() -> dict:
+    global _ff_cache
+    if _ff_cache is None:
+        raw = kv_get(_FF_CACHE_KEY)
+        _ff_cache = json.loads(raw) if raw else {}
+    return _ff_cache
+
+def _save_ff_cache(cache: dict):
+    global _ff_cache
+    _ff_cache = cache
+    kv_set(_FF_CACHE_KEY, json.dumps(cache))
+
+def _read_capped(res, limit: int):
+    """Czyta strumieniowo ciało odpowiedzi jako bytes; None, jeśli przekracza limit."""
+    chunks = []
+    size = 0
+    for chunk in res.iter_content(chunk_size=64 * 1024):
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
 def fetch_forex_today():
     try:
-        res = requests.get(FOREX_FACTORY_URL, params={"day": "today"}, timeout=15)
-        if res.status_code != 200:
+        today = date.today().isoformat()
+        cache = _load_ff_cache()
+        headers = {}
+        if cache.get("day") == today:
+            if cache.get("etag"):
+                headers["If-None-Match"] = cache["etag"]
+            if cache.get("last_modified"):
+                headers["If-Modified-Since"] = cache["last_modified"]
+        with HTTP.get(FOREX_FACTORY_URL, params={"day": "today"}, headers=headers, timeout=15, stream=True) as res:
+            if res.status_code == 304:
+                logger.info("ForexFactory bez zmian (304) - używam zapisanych wydarzeń")
+                return cache.get("events", [])
+            if res.status_code != 200:
+                return []
+            content = _read_capped(res, FOREX_MAX_BYTES)
+        if content is None:
+            logger.warning("Strona ForexFactory większa niż %d B - pomijam", FOREX_MAX_BYTES)
             return []
-        soup = BeautifulSoup(res.text, "html.parser")
-        rows = soup.select("table#calendar tbody tr")
-        events = []
-        for tr in rows:
-            tds = tr.find_all("td")
-            if len(tds) < 6:
-                continue
-            time_txt = tds[0].get_text(strip=True)
-            currency = tds[1].get_text(strip=True)
-            impact = tds[2].get_text(strip=True)
-            event = tds[3].get_text(strip=True)
-            actual = tds[4].get_text(strip=True)
-            forecast = tds[5].get_text(strip=True)
-            impact_l = impact.lower()
-            if any(k in impact_l for k in ("med", "high", "important", "red")):
-                if "low" in impact_l:
-                    continue
-                eid = f"ff:{date.today().isoformat()}:{currency}:{event}:{time_txt}"
-                events.append({
-                    "id": eid, "time": time_txt, "currency": currency, "impact": impact,
-                    "event": event, "actual": actual, "forecast": forecast
-                })
+        events = parse_forex_html(content, today)
+        _save_ff_cache({
+            "day": today,
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+            "events": events,
+        })
         return events
     except Exception as e:
         logger.exception("Błąd przy pobieraniu FF: %s", e)
         return []
 
+def parse_forex_html(content: bytes, today: str):
+    doc = lxml_html.fromstring(content)
+    events = []
+    for tr in _ROW_XPATH(doc):
+        tds = _TD_XPATH(tr)
+        if len(tds) < 6:
+            continue
+        time_txt, currency, impact, event, actual, forecast = (_cell_text(td) for td in tds[:6])
+        level = impact_level(impact)
+        if level < 1:
+            continue
+        eid = f"ff:{today}:{currency}:{event}:{time_txt}"
+        events.append({
+            "id": eid, "time": time_txt, "currency": currency, "impact": impact,
+            "impact_level": level, "event": event, "actual": actual, "forecast": forecast
+        })
+    return events
+
 # === AI ANALYSIS ===
+_AI_SYSTEM_PROMPT = "Jesteś ekspertem finansowym, mówisz po polsku."
+
+def _fallback_analysis(event):
+    return f"{event.get('event')} ({event.get('currency')}) — możliwe wahania, szczególnie przy odchyleniach od prognoz."
+
 def analyze_event_with_ai(event):
     prompt = f"""
 Jesteś asystentem rynkowym. W kilku zdaniach po polsku opisz znaczenie wydarzenia:
@@ -186,20 +503,72 @@ Forecast: {event.get('forecast')}
 Actual: {event.get('actual')}
 """
     try:
-        if OPENAI_API_KEY and OPENAI_AVAILABLE:
-            resp = openai.ChatCompletion.create(
-                model="gpt-4",
+        if ai_client is not None:
+            resp = ai_client.chat.completions.create(
+                model=OPENAI_MODEL,
                 messages=[
-                    {"role": "system", "content": "Jesteś ekspertem finansowym, mówisz po polsku."},
+                    {"role": "system", "content": _AI_SYSTEM_PROMPT},
                     {"role": "user", "content": prompt}
                 ],
                 max_tokens=160,
                 temperature=0.2,
             )
-            return resp["choices"][0]["message"]["content"].strip()
+            return resp.choices[0].message.content.strip()
     except Exception as e:
         logger.exception("OpenAI error: %s", e)
-    return f"{event.get('event')} ({event.get('currency')}) — możliwe wahania, szczególnie przy odchyleniach od prognoz."
+    return _fallback_analysis(event)
+
+def analyze_events_concurrently(events):
+    """Analizuje wydarzenia równolegle - czas ~1 zapytania do OpenAI zamiast N."""
+    if not events:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(AI_CONCURRENCY, len(events)))) as pool:
+        return list(pool.map(analyze_event_with_ai, events))
+
+def analyze_events_with_ai(events):
+    """Analizuje wszystkie wydarzenia jednym zapytaniem do OpenAI (odpowiedź w JSON).
+
+    Jeśli odpowiedź nie jest poprawnym JSON-em, wraca do analizy per wydarzenie.
+    """
+    if not events:
+        return []
+    if ai_client is None:
+        return [_fallback_analysis(e) for e in events]
+    listing = "\n".join(
+        f"{i}. {e.get('event')} | Waluta: {e.get('currency')} | Impact: {e.get('impact')} | "
+        f"Czas: {e.get('time')} | Forecast: {e.get('forecast')} | Actual: {e.get('actual')}"
+        for i, e in enumerate(events, 1)
+    )
+    prompt = f"""
+Jesteś asystentem rynkowym. Dla każdego wydarzenia z listy w kilku zdaniach po polsku opisz jego znaczenie.
+Odpowiedz wyłącznie JSON-em: {{"analyses": [{{"index": 1, "analysis": "..."}}, ...]}} - jeden wpis na wydarzenie.
+
+{listing}
+"""
+    try:
+        resp = ai_client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": _AI_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=min(160 * len(events) + 100, 4096),
+            temperature=0.2,
+            response_format={"type": "json_object"},
+        )
+        items = json.loads(resp.choices[0].message.content)["analyses"]
+        by_index = {int(it["index"]): str(it["analysis"]).strip() for it in items}
+    except (ValueError, KeyError, TypeError) as exc:
+        logger.warning("Niepoprawny JSON z OpenAI, analizuję wydarzenia osobno: %s", exc)
+        return analyze_events_concurrently(events)
+    except Exception as exc:
+        logger.exception("OpenAI error: %s", exc)
+        return [_fallback_analysis(e) for e in events]
+    # Wydarzenia pominięte w odpowiedzi analizujemy osobno
+    missing = [i for i in range(1, len(events) + 1) if not by_index.get(i)]
+    for i, analysis in zip(missing, analyze_events_concurrently([events[i - 1] for i in missing])):
+        by_index[i] = analysis
+    return [by_index[i] for i in range(1, len(events) + 1)]
 
 # === FOREX DAILY JOB ===
 def forex_daily_job():
@@ -209,23 +578,40 @@ def forex_daily_job():
             bot.send_message(TARGET_CHAT_ID, "📅 ForexFactory: brak wydarzeń medium/high.")
             return
         lines = ["📊 <b>ForexFactory — dzisiejsze wydarzenia:</b>\n"]
-        for e in events:
-            if was_sent(e["id"]):
-                continue
-            analysis = analyze_event_with_ai(e)
+        already = filter_sent(e["id"] for e in events)
+        events = [e for e in events if e["id"] not in already]
+        analyses = analyze_events_with_ai(events)
+        for e, analysis in zip(events, analyses):
             lines.append(f"<b>{e['time']} | {e['currency']} | {e['impact']}</b>\n{e['event']}\n{analysis}\n---\n")
+        for e in events:
             mark_sent(e["id"], "forex")
+        flush_sent()
         bot.send_message(TARGET_CHAT_ID, "\n".join(lines), parse_mode=ParseMode.HTML)
     except Exception as e:
         logger.exception("Błąd w forex_daily_job: %s", e)
 
-# === FLASK (keep alive + webhook) ===
+# === FLASK (keep alive + webhook, serwowany przez waitress) ===
 app = Flask(__name__)
 
+# Odpowiedzi na komendy wysyłamy poza wątkiem requestu - Telegram dostaje 200 od razu
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+def _send_reply(chat_id, text):
+    try:
+        bot.send_message(chat_id, text)
+    except TelegramError as e:
+        logger.exception("Błąd wysyłki odpowiedzi do Telegrama: %s", e)
+
 @app.route('/')
 def home():
     return "✅ Bot is running and responding!", 200
 
+_COMMAND_REPLIES = {
+    "/status": "✅Bot aktywny✅",
+    "/help": "📋 Dostępne komendy:\n/status — sprawdź, czy bot działa\n/help — lista komend",
+}
+_UNKNOWN_COMMAND_REPLY = "Nieznana komenda. Użyj /help."
+
 @app.route(f'/{TELEGRAM_TOKEN}', methods=['POST'])
 def telegram_webhook():
     update = request.get_json(force=True)
@@ -238,29 +624,36 @@ def telegram_webhook():
 
     text_lower = text.strip().lower()
 
-    if text_lower == "/status":
-        bot.send_message(chat_id, "✅Bot aktywny✅")
-    elif text_lower == "/help":
-        bot.send_message(chat_id, "📋 Dostępne komendy:\n/status — sprawdź, czy bot działa\n/help — lista komend")
-    else:
-        bot.send_message(chat_id, "Nieznana komenda. Użyj /help.")
+    reply = _COMMAND_REPLIES.get(text_lower, _UNKNOWN_COMMAND_REPLY)
+    EXECUTOR.submit(_send_reply, chat_id, reply)
     return "OK", 200
 
 def run_flask():
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, use_reloader=False)
+    serve(app, host="0.0.0.0", port=port, threads=4, connection_limit=100)
 
 # === MAIN ===
+def schedule_x_polling(scheduler):
+    scheduler.add_job(x_poll_job, "interval", seconds=POLL_INTERVAL, next_run_time=datetime.utcnow(),
+                      id="x_poll", replace_existing=True)
+
 def main():
     init_db()
-    scheduler = BackgroundScheduler(timezone=utc)
-    scheduler.add_job(x_poll_job, "interval", seconds=POLL_INTERVAL, next_run_time=datetime.utcnow())
+    setup_webhook()
+    atexit.register(flush_sent)
+    scheduler = BlockingScheduler(timezone=utc)
+    if X_STREAM and TWEEPY_AVAILABLE and X_BEARER_TOKEN and X_USERNAME:
+        # Jednorazowy poll na starcie nadrabia wpisy z czasu, gdy bot nie działał.
+        # misfire_grace_time=None - zadania wykonają się nawet przy opóźnionym starcie.
+        scheduler.add_job(x_poll_job, "date", misfire_grace_time=None)
+        scheduler.add_job(start_x_stream_job, "date", args=[scheduler], misfire_grace_time=None)
+    else:
+        schedule_x_polling(scheduler)
     scheduler.add_job(forex_daily_job, "cron", hour=FOREX_DAILY_HOUR, minute=0)
-    scheduler.start()
+    scheduler.add_job(prune_sent_job, "cron", hour=3, minute=30)
     logger.info("Bot wystartował. Harmonogram uruchomiony.")
     try:
-        while True:
-            time.sleep(60)
+        scheduler.start()
     except (KeyboardInterrupt, SystemExit):
         logger.info("Stopping...")
 